@@ -3,16 +3,26 @@
 # author: Jens Luebeck (jluebeck [at] ucsd.edu)
 
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+import glob
+import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
+import runpy
+import shutil
 import socket
 from subprocess import *
 import sys
 import tarfile
-import time
+from time import perf_counter
 
 from paalib import check_reference, reduce_fasta
 from paalib._version import __ampliconsuitepipeline_version__
@@ -21,49 +31,234 @@ from paalib._version import __ampliconsuitepipeline_version__
 PY3_PATH = "python3"  # updated by command-line arg if specified
 metadata_dict = {}  # stores the run metadata (bioinformatic metadata)
 sample_info_dict = {}  # stores the sample metadata
+stage_times = {}  # walltime in seconds of each pipeline stage
+PIGZ_PATH = shutil.which("pigz")  # parallel gzip, used for compression when available
+CSI_INDEX_MIN_BYTES = 4 * 1024 ** 3  # BAMs larger than this are indexed with .csi instead of .bai
+
+
+# run a command, raising CalledProcessError on a non-zero exit status. Commands given as a string need shell features
+# (pipes, redirection, globs) and are run through bash with pipefail, so that a failure anywhere in a pipeline is
+# reported. All others are run directly from their argument list.
+def _run(cmd):
+    if isinstance(cmd, str):
+        return run("set -o pipefail; " + cmd, shell=True, executable="/bin/bash", check=True)
+
+    return run(cmd, check=True)
+
+
+# run a python script. When running single-threaded and the script targets this same interpreter, it is run in-process
+# with runpy to avoid starting a new interpreter, otherwise it is launched as a subprocess. Raises CalledProcessError
+# on a non-zero exit status or an uncaught exception in both cases.
+def _run_py_script(interpreter, script, script_args, nthreads=1):
+    cmd_list = [interpreter, script] + script_args
+    interpreter_path = shutil.which(interpreter)
+    if int(nthreads) > 1 or not interpreter_path or \
+            os.path.realpath(interpreter_path) != os.path.realpath(sys.executable):
+        return _run(cmd_list)
+
+    saved_argv, saved_path = sys.argv, list(sys.path)
+    sys.argv = [script] + script_args
+    sys.path.insert(0, os.path.dirname(os.path.realpath(script)))
+    try:
+        runpy.run_path(script, run_name="__main__")
+
+    except SystemExit as e:
+        if e.code:
+            raise CalledProcessError(e.code if isinstance(e.code, int) else 1, cmd_list)
+
+    # an uncaught exception would end a subprocess with exit status 1 and a traceback on stderr
+    except Exception:
+        logging.exception("Error while running " + script)
+        raise CalledProcessError(1, cmd_list)
+
+    finally:
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+
+
+# gzip a file in place, using multiple threads through pigz if it is installed
+def _gzip(fname, nthreads=1):
+    if PIGZ_PATH:
+        cmd_list = [PIGZ_PATH, "-f", "-p", str(nthreads), fname]
+    else:
+        cmd_list = ["gzip", "-f", fname]
+
+    logging.info(" ".join(cmd_list))
+    _run(cmd_list)
+
+
+# record the walltime elapsed since start for a stage. The times are written to the timing log once, at exit.
+def _record_stage_time(name, start):
+    stage_times[name] = perf_counter() - start
+
+
+# write the recorded stage times to the timing log. Registered to run at exit, so it also covers failed runs.
+def _write_stage_times(timing_log_filename):
+    with open(timing_log_filename, 'w') as outfile:
+        outfile.write("#stage:\twalltime(seconds)\n")
+        outfile.write("".join("{}\t{:.2f}\n".format(k, v) for k, v in stage_times.items()))
+
+
+# time a pipeline stage, recording its walltime when it completes
+@contextmanager
+def stage(name):
+    start = perf_counter()
+    yield
+    _record_stage_time(name + ":", start)
+
+
+# run the properly-paired QC as its own timed stage. It runs in the background, so it cannot be timed by the
+# surrounding stage.
+def _timed_properly_paired_check(bamf, samtools):
+    with stage("QC"):
+        return check_reference.check_properly_paired(bamf, samtools)
+
+
+# stop the run if the background QC has already finished with a fatal result. result() re-raises the QC's exception,
+# including the SystemExit from a BAM that is unsuitable for AA.
+def _check_qc_future(qc_future, wait=False):
+    if qc_future and (wait or qc_future.done()):
+        return qc_future.result()
+
+    return None
+
+
+# write a dictionary to a file as indented JSON, using the faster orjson encoder if it is installed
+def _dump_json(obj, fname):
+    try:
+        import orjson
+
+    except ImportError:
+        with open(fname, 'w') as fp:
+            json.dump(obj, fp, indent=2)
+
+        return
 
+    with open(fname, 'wb') as fp:
+        fp.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
 
-def run_bwa(ref_fasta, fastqs, outdir, sname, nthreads, samtools, samtools_version):
-    outname = outdir + sname
+
+# remove a list of files, ignoring any that are already gone
+def _remove_files(fnames):
+    for f in fnames:
+        try:
+            os.remove(f)
+
+        except FileNotFoundError:
+            pass
+
+
+def run_bwa(ref_fasta, fastqs, outdir, sname, nthreads, samtools, samtools_version, cram=False):
+    outname = os.path.join(outdir, sname)
     logging.info("Output prefix: " + outname)
     exts = [".sa", ".amb", ".ann", ".pac", ".bwt"]
+    # list the reference directory once instead of checking each index file separately
+    ref_dir_entries = {e.name for e in os.scandir(os.path.dirname(ref_fasta) or ".")}
+    base = os.path.basename(ref_fasta)
     indexPresent = True
     for i in exts:
-        if not os.path.exists(ref_fasta + i):
+        if base + i not in ref_dir_entries:
             indexPresent = False
             logging.info("Could not find " + ref_fasta + i + ", building BWA index from scratch. This could take > 60 minutes")
             break
 
     if not indexPresent:
-        cmd = "bwa index " + ref_fasta
-        call(cmd, shell=True)
+        try:
+            _run(["bwa", "index", ref_fasta])
+
+        except CalledProcessError:
+            logging.error("bwa index encountered a non-zero exit status. Exiting...\n")
+            sys.exit(1)
+
+    final_bam_name = "{}.cs.rmdup.bam".format(outname)
+    # samtools markdup (>= 1.6) can be chained directly after alignment, avoiding a separate rmdup pass over the BAM.
+    usingDeprecatedSamtools = samtools_version < (1, 6)
+    # samtools >= 1.10 can also build the .bai while markdup writes the BAM, rather than re-reading it afterwards.
+    writeIndex = samtools_version >= (1, 10)
+    if cram and not writeIndex:
+        logging.warning("CRAM output requires samtools >= 1.10. Writing a BAM file instead.")
+        cram = False
+
+    if not usingDeprecatedSamtools:
+        logging.info("Performing alignment, sorting and duplicate removal\n")
+        markdup_out = "-r - " + final_bam_name
+        if cram:
+            # reference-based compression makes the file read by all the later stages much smaller than a BAM
+            final_bam_name = "{}.cs.rmdup.cram".format(outname)
+            markdup_out = "--write-index -O cram --reference {} -r - {}##idx##{}.crai".format(ref_fasta, final_bam_name,
+                                                                                              final_bam_name)
+        elif writeIndex:
+            markdup_out = "--write-index -r - {}##idx##{}.bai".format(final_bam_name, final_bam_name)
+
+        # the streams between fixmate, sort and markdup are left uncompressed, only the final BAM is written at the
+        # default level. fixmate only accepts -u from samtools 1.13. sort writes to stdout, so give it a temp file
+        # prefix to keep its spill files in the output directory.
+        fixmate_opts = "-u -m" if samtools_version >= (1, 13) else "-m"
+        cmd = "{{ bwa mem -K 10000000 -t {} {} {} | {} fixmate {} -@ {} - - | {} sort -l 0 -m 1G -@ {} -T {}.sort_tmp - | " \
+              "{} markdup -@ {} {}; }} 2>{}_aln_stage.stderr".format(nthreads, ref_fasta, fastqs, samtools, fixmate_opts,
+                                                                    nthreads, samtools, nthreads, outname, samtools,
+                                                                    nthreads, markdup_out, outname)
+        logging.info(cmd + "\n")
+        try:
+            _run(cmd)
+
+        except CalledProcessError:
+            logging.error("Alignment encountered a non-zero exit status. See " + outname + "_aln_stage.stderr. "
+                          "Exiting...\n")
+            sys.exit(1)
+
+        metadata_dict["bwa_cmd"] = cmd
 
-    logging.info("Performing alignment and sorting\n")
-    if samtools_version[0] < 1:
-        cmd = "{{ bwa mem -K 10000000 -t {} {} {} | {} view -Shu - | {} sort -m 4G -@4 - {}.cs; }} 2>{}_aln_stage.stderr".format(
-            nthreads, ref_fasta, fastqs, samtools, samtools, outname, outname)
     else:
-        cmd = "{{ bwa mem -K 10000000 -t {} {} {} | {} view -Shu - | {} sort -m 4G -@4 -o {}.cs.bam -; }} 2>{}_aln_stage.stderr".format(
-            nthreads, ref_fasta, fastqs, samtools, samtools, outname, outname)
+        logging.info("Performing alignment and sorting\n")
+        # samtools >= 1.0 sort reads SAM from stdin directly, so no intermediate 'view' conversion is needed. Keep the
+        # per-thread sort memory small so that sort does not stall bwa while flushing large buffers.
+        if samtools_version[0] < 1:
+            cmd = "{{ bwa mem -K 10000000 -t {} {} {} | {} view -Shu - | {} sort -m 1G -@ {} - {}.cs; }} 2>{}_aln_stage.stderr".format(
+                nthreads, ref_fasta, fastqs, samtools, samtools, nthreads, outname, outname)
+        else:
+            # the temporary .cs.bam is only read once by rmdup, so write it with fast, light compression
+            cmd = "{{ bwa mem -K 10000000 -t {} {} {} | {} sort -l 1 -m 1G -@ {} -o {}.cs.bam -; }} 2>{}_aln_stage.stderr".format(
+                nthreads, ref_fasta, fastqs, samtools, nthreads, outname, outname)
 
-    logging.info(cmd + "\n")
-    call(cmd, shell=True)
-    metadata_dict["bwa_cmd"] = cmd
+        logging.info(cmd + "\n")
+        try:
+            _run(cmd)
+
+        except CalledProcessError:
+            logging.error("Alignment encountered a non-zero exit status. See " + outname + "_aln_stage.stderr. "
+                          "Exiting...\n")
+            sys.exit(1)
+
+        metadata_dict["bwa_cmd"] = cmd
+
+        logging.info("Performing duplicate removal")
+        cmd_list = [samtools, "rmdup", "-s", "{}.cs.bam".format(outname), final_bam_name]
+        logging.info(" ".join(cmd_list) + "\n")
+        try:
+            _run(cmd_list)
+
+        except CalledProcessError:
+            logging.error("samtools rmdup encountered a non-zero exit status. Exiting...\n")
+            sys.exit(1)
+
+        logging.info("Removing temp BAM\n")
+        _remove_files(["{}.cs.bam".format(outname)])
+
+    if usingDeprecatedSamtools or not writeIndex:
+        logging.info("Running samtools index")
+        cmd_list = [samtools, "index", final_bam_name]
+        if not usingDeprecatedSamtools:
+            cmd_list[2:2] = ["-@", str(nthreads)]
+
+        logging.info(" ".join(cmd_list) + "\n")
+        try:
+            _run(cmd_list)
+
+        except CalledProcessError:
+            logging.error("samtools index encountered a non-zero exit status. Exiting...\n")
+            sys.exit(1)
 
-    logging.info("Performing duplicate marking & indexing")
-    final_bam_name = "{}.cs.rmdup.bam".format(outname)
-    cmd_list = [samtools, "rmdup", "-s", "{}.cs.bam".format(outname), final_bam_name]
-    logging.info(" ".join(cmd_list) + "\n")
-    call(cmd_list)
-
-    logging.info("Running samtools index")
-    cmd_list = [samtools, "index", final_bam_name]
-    logging.info(" ".join(cmd_list) + "\n")
-    call(cmd_list)
-
-    logging.info("Removing temp BAM\n")
-    cmd = "rm {}.cs.bam".format(outname)
-    call(cmd, shell=True)
     return final_bam_name, outname + "_aln_stage.stderr"
 
 
@@ -76,70 +271,91 @@ def run_freebayes(ref, bam_file, outdir, sname, nthreads, regions, fb_path=None)
     fb_exec = "freebayes"
     if fb_path:
         fb_exec = fb_path + "/" + fb_exec
-    while True:
-        try:
-            curr_region_tup = regions.pop()
-        except IndexError:
-            break
 
-        curr_region_string = curr_region_tup[0] + ":" + curr_region_tup[1]
-        logging.info(curr_region_string + ". " + str(len(regions)) + " items remaining.")
-        vcf_file = outdir + sname + "_" + curr_region_tup[0] + "_" + curr_region_tup[2] + ".vcf"
-        replace_filter_field_func = "awk '{ if (substr($1,1,1) != \"#\" ) { $7 = ($7 == \".\" ? \"PASS\" : $7 ) }} 1 ' OFS=\"\\t\""
-        cmd = "{} --genotype-qualities --standard-filters --use-best-n-alleles 5 --limit-coverage 25000 \
-        --strict-vcf -f {} -r {} {} | {} > {}".format(fb_exec, ref, curr_region_string, bam_file,
-                                                      replace_filter_field_func, vcf_file)
-        logging.info(cmd)
-        call(cmd, shell=True)
-        # gzip the new VCF
-        call("gzip -f " + vcf_file, shell=True)
-
-
-# This is not currently used by AmpliconSuite-pipeline.
-def merge_and_filter_vcfs(chr_names, vcf_list, outdir, sname):
+    # freebayes is single-threaded, so call the independent regions in parallel worker processes. Results are collected
+    # as each region finishes, and the paths of the region VCFs are returned in the order of the regions.
+    jobs = [(i, fb_exec, ref, bam_file, outdir, sname, x) for i, x in enumerate(regions)]
+    nprocs = max(1, int(nthreads))
+    vcf_files = [None] * len(jobs)
+    with multiprocessing.Pool(nprocs) as p:
+        for i, vcf_file in p.imap_unordered(_call_one_region, jobs, chunksize=max(1, len(jobs) // (nprocs * 4))):
+            vcf_files[i] = vcf_file
+
+    return vcf_files
+
+
+def _call_one_region(job):
+    job_index, fb_exec, ref, bam_file, outdir, sname, curr_region_tup = job
+    curr_region_string = curr_region_tup[0] + ":" + curr_region_tup[1]
+    logging.info("Calling " + curr_region_string)
+    vcf_file = os.path.join(outdir, "{}_{}_{}.vcf.gz".format(sname, curr_region_tup[0], curr_region_tup[2]))
+    cmd_list = [fb_exec, "--genotype-qualities", "--standard-filters", "--use-best-n-alleles", "4", "--limit-coverage",
+                "25000", "--strict-vcf", "-f", ref, "-r", curr_region_string, bam_file]
+    logging.info(" ".join(cmd_list))
+    # set an empty FILTER field to PASS and write the records straight to the gzipped VCF
+    p = Popen(cmd_list, stdout=PIPE, bufsize=1 << 20)
+    with gzip.open(vcf_file, 'wb') as outfile:
+        for line in p.stdout:
+            if not line.startswith(b'#'):
+                fields = line.split(b'\t', 7)
+                if fields[6] == b'.':
+                    fields[6] = b'PASS'
+                    line = b'\t'.join(fields)
+
+            outfile.write(line)
+
+    p.stdout.close()
+    # fail the pool rather than let a truncated region VCF be merged
+    if p.wait() != 0:
+        logging.error("freebayes returned a non-zero exit code on " + curr_region_string)
+        raise CalledProcessError(p.returncode, cmd_list)
+
+    return job_index, vcf_file
+
+
+# This is not currently used by AmpliconSuite-pipeline. It is kept, with run_freebayes, for when VCF calling is
+# re-enabled, at which point bcftools becomes a dependency of the pipeline.
+# vcf_list holds the region VCFs in genome order, as returned by run_freebayes.
+def merge_and_filter_vcfs(vcf_list, outdir, sname, nthreads=1):
     logging.info("Merging VCFs and zipping...\n")
-    # collect the vcf files to merge
-    merged_vcf_file = outdir + sname + "_merged.vcf"
-    relevant_vcfs = [x for x in vcf_list if any([i in x for i in chr_names])]
-    chrom_vcf_d = {}
-    for f in relevant_vcfs:
-        curr_chrom = f.rsplit(".vcf.gz")[0].rsplit("_")[-2:]
-        chrom_vcf_d[curr_chrom[0] + curr_chrom[1]] = f
-
-    # chr_nums = [x.lstrip("chr") for x in chr_names]
-    pre_chr_str_names = [str(x) for x in range(1, 23)] + ["X", "Y"]
-
-    # sort the elements
-    # include the header from the first one
-    if args.ref != "GRCh37" and args.ref != "GRCm38":
-        sorted_chr_names = ["chr" + str(x) for x in pre_chr_str_names]
-        cmd = "zcat " + chrom_vcf_d["chrM"] + ''' | awk '$4 != "N"' > ''' + merged_vcf_file
-
-    else:
-        sorted_chr_names = [str(x) for x in pre_chr_str_names]
-        cmd = "zcat " + chrom_vcf_d["MT"] + ''' | awk '$4 != "N"' > ''' + merged_vcf_file
-
-    logging.info(cmd + "\n")
-    call(cmd, shell=True)
-
-    # zcat the rest, grepping out all header lines starting with "#"
-    logging.debug(sorted_chr_names)
-    for i in sorted_chr_names:
-        if i == "chrM" or i == "MT":
-            continue
-
-        cmd_p = "zcat " + chrom_vcf_d[i + "p"] + ''' | grep -v "^#" | awk '$4 != "N"' >> ''' + merged_vcf_file
-        cmd_q = "zcat " + chrom_vcf_d[i + "q"] + ''' | grep -v "^#" | awk '$4 != "N"' >> ''' + merged_vcf_file
-        logging.info(cmd_p)
-        call(cmd_p, shell=True)
-        logging.info(cmd_q)
-        call(cmd_q, shell=True)
+    merged_vcf_file = os.path.join(outdir, sname + "_merged.vcf")
+    ordered_vcfs = list(vcf_list)
+    # concatenate the region VCFs in a single bcftools call (keeping the header of the first one), and drop records with
+    # an 'N' reference allele while writing the compressed output. The regions are disjoint and already in genome order,
+    # so this is a plain concat. The file list is passed with -f to stay clear of argument length limits.
+    vcf_list_file = merged_vcf_file + "_file_list.txt"
+    with open(vcf_list_file, 'w') as outfile:
+        outfile.write("\n".join(ordered_vcfs) + "\n")
+
+    concat_cmd = ["bcftools", "concat", "--threads", str(nthreads), "-f", vcf_list_file, "-Ou"]
+    filter_cmd = ["bcftools", "view", "--threads", str(nthreads), "-e", 'REF="N"', "-Oz", "-o", merged_vcf_file + ".gz"]
+    logging.info(" ".join(concat_cmd) + " | " + " ".join(filter_cmd))
+    concat_p = Popen(concat_cmd, stdout=PIPE)
+    filter_p = Popen(filter_cmd, stdin=concat_p.stdout)
+    concat_p.stdout.close()
+    filter_p.communicate()
+    _remove_files([vcf_list_file])
+    if concat_p.wait() != 0:
+        logging.error("bcftools returned a non-zero exit code while merging VCFs")
+        raise CalledProcessError(concat_p.returncode, concat_cmd)
+
+    if filter_p.returncode != 0:
+        logging.error("bcftools returned a non-zero exit code while merging VCFs")
+        raise CalledProcessError(filter_p.returncode, filter_cmd)
+
+    index_cmd = ["bcftools", "index", "--threads", str(nthreads), "-t", merged_vcf_file + ".gz"]
+    logging.info(" ".join(index_cmd))
+    _run(index_cmd)
+    return merged_vcf_file + ".gz"
 
-    cmd = "gzip -f " + merged_vcf_file
-    logging.info(cmd)
-    call(cmd, shell=True)
 
-    return merged_vcf_file + ".gz"
+# path of the cached CNVkit reference built from a matched normal in cache_dir. The entry is keyed by the normal BAM
+# (path, mtime and size), the reference genome and the CNVkit version, so a change to any of them builds a new reference.
+def _cnvkit_normal_ref_cache_path(cache_dir, normal, ref_fasta):
+    st = os.stat(normal)
+    key = "{}\t{}\t{}\t{}\t{}".format(os.path.realpath(normal), st.st_mtime_ns, st.st_size, os.path.realpath(ref_fasta),
+                                      metadata_dict.get("cnvkit_version", ""))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".cnn")
 
 
 def run_cnvkit(ckpy_path, nthreads, outdir, bamfile, seg_meth='cbs', normal=None, ref_fasta=None, vcf=None):
@@ -150,74 +366,102 @@ def run_cnvkit(ckpy_path, nthreads, outdir, bamfile, seg_meth='cbs', normal=None
     # -p: number of threads
     # -f: reference genome fasta
     bamBase = os.path.splitext(os.path.basename(bamfile))[0]
-    cnvkit_version = Popen([PY3_PATH, ckpy_path, "version"], stdout=PIPE, stderr=PIPE).communicate()[0].rstrip()
-    try:
-        cnvkit_version = cnvkit_version.decode('utf-8')
-    except UnicodeError:
-        pass
-
-    metadata_dict["cnvkit_version"] = cnvkit_version
-
     ckRef = AA_REPO + args.ref + "/" + args.ref + "_cnvkit_filtered_ref.cnn"
     if normal and args.ref == "GRCh38_viral":
         logging.warning("CNVkit does not properly support matched tumor-normal with viral genomes. Ignoring matched-"
                         "normal and running in tumor-only mode.\n")
         
     logging.info("Running CNVKit batch\n")
+    build_normal_ref = False
+    normal_ref_cache = None
     if normal and not args.ref == "GRCh38_viral":
-        # create a version of the stripped reference
-        reduce_fasta.reduce_fasta(ref_fasta, ref_genome_size_file, outdir)
-        base = os.path.basename(ref_fasta) # args.ref is the name, ref is the fasta
-        stripRefG = outdir + os.path.splitext(base)[0] + "_reduced" + "".join(os.path.splitext(base)[1:])
-        logging.debug("Stripped reference: " + stripRefG)
-        cmd = "{} {} batch {} -m wgs --fasta {} -p {} -d {} --normal {}".format(PY3_PATH, ckpy_path, bamfile, stripRefG,
-                                                                                nthreads, outdir, normal)
+        # with --cnvkit_ref_cache_dir, the reference built from a matched normal is cached so that other samples sharing
+        # the normal reuse it
+        if args.cnvkit_ref_cache_dir:
+            normal_ref_cache = _cnvkit_normal_ref_cache_path(args.cnvkit_ref_cache_dir, normal, ref_fasta)
+
+        if normal_ref_cache and os.path.exists(normal_ref_cache):
+            logging.info("Using cached CNVkit reference for " + normal + ": " + normal_ref_cache)
+            cmd_list = [PY3_PATH, ckpy_path, "batch", "-m", "wgs", "-r", normal_ref_cache, "-p", str(nthreads), "-d",
+                        outdir, bamfile]
+
+        else:
+            build_normal_ref = True
+            # create a version of the stripped reference
+            reduce_fasta.reduce_fasta(ref_fasta, ref_genome_size_file, os.path.join(outdir, ""))
+            base = os.path.basename(ref_fasta) # args.ref is the name, ref is the fasta
+            stripRefG = os.path.join(outdir, os.path.splitext(base)[0] + "_reduced" + "".join(os.path.splitext(base)[1:]))
+            logging.debug("Stripped reference: " + stripRefG)
+            cmd_list = [PY3_PATH, ckpy_path, "batch", bamfile, "-m", "wgs", "--fasta", stripRefG, "-p", str(nthreads),
+                        "-d", outdir, "--normal", normal]
+            if normal_ref_cache:
+                normal_ref = os.path.join(outdir, "normal_reference.cnn")
+                cmd_list.extend(["--output-reference", normal_ref])
+
     else:
-        cmd = "{} {} batch -m wgs -r {} -p {} -d {} {}".format(PY3_PATH, ckpy_path, ckRef, nthreads, outdir, bamfile)
+        cmd_list = [PY3_PATH, ckpy_path, "batch", "-m", "wgs", "-r", ckRef, "-p", str(nthreads), "-d", outdir, bamfile]
 
+    cmd = " ".join(cmd_list)
     logging.info(cmd + "\n")
-    call(cmd, shell=True)
+    try:
+        _run(cmd_list)
+
+    except CalledProcessError:
+        logging.error("CNVKit encountered a non-zero exit status. Exiting...\n")
+        sys.exit(1)
+
     metadata_dict["cnvkit_cmd"] = cmd + " ; "
-    rscript_str = ""
+    if build_normal_ref and normal_ref_cache:
+        try:
+            os.makedirs(os.path.dirname(normal_ref_cache), exist_ok=True)
+            tmp_file = "{}.{}.tmp".format(normal_ref_cache, os.getpid())
+            shutil.copyfile(normal_ref, tmp_file)
+            os.replace(tmp_file, normal_ref_cache)
+
+        except OSError as e:
+            logging.warning("Could not cache CNVkit reference: {}".format(e))
+
+    rscript_args = []
     if args.rscript_path:
-        rscript_str = "--rscript-path " + args.rscript_path
-        logging.info("Set Rscript flag: " + rscript_str)
+        rscript_args = ["--rscript-path", args.rscript_path]
+        logging.info("Set Rscript flag: " + " ".join(rscript_args))
 
-    cnrFile = outdir + bamBase + ".cnr"
-    cnsFile = outdir + bamBase + ".cns"
+    cnrFile = os.path.join(outdir, bamBase + ".cnr")
+    cnsFile = os.path.join(outdir, bamBase + ".cns")
     logging.info("Running CNVKit segment")
     # TODO: possibly include support for adding VCF calls.
-    cmd = "{} {} segment {} {} -p {} -m {} -o {}".format(PY3_PATH, ckpy_path, cnrFile, rscript_str, nthreads, seg_meth,
-                                                         cnsFile)
+    cmd_list = [PY3_PATH, ckpy_path, "segment", cnrFile] + rscript_args + ["-p", str(nthreads), "-m", seg_meth, "-o",
+                                                                          cnsFile]
+    cmd = " ".join(cmd_list)
     logging.info(cmd + "\n")
-    exit_code = call(cmd, shell=True)
-    if exit_code != 0:
+    try:
+        _run(cmd_list)
+
+    except CalledProcessError:
         logging.error("CNVKit encountered a non-zero exit status. Exiting...\n")
         sys.exit(1)
 
     metadata_dict["cnvkit_cmd"] = metadata_dict["cnvkit_cmd"] + cmd
     logging.info("Cleaning up temporary CNVkit files")
-    cmd = "rm -f {}/*tmp.bed {}/*.cnn {}/*target.bed {}/*.bintest.cns".format(outdir, outdir, outdir, outdir)
-    logging.info(cmd)
-    call(cmd, shell=True)
-    cmd = "gzip -f " + cnrFile
-    logging.info(cmd)
-    call(cmd, shell=True)
-    if normal and not args.ref == "GRCh38_viral":
-        cmd = "rm " + stripRefG + " " + stripRefG + ".fa"
-        logging.info(cmd)
-        call(cmd, shell=True)
+    for pattern in ["*tmp.bed", "*.cnn", "*target.bed", "*.bintest.cns"]:
+        _remove_files(glob.glob(os.path.join(outdir, pattern)))
+
+    _gzip(cnrFile, nthreads)
+    if build_normal_ref:
+        logging.info("Removing " + stripRefG)
+        _remove_files([stripRefG, stripRefG + ".fa"])
 
 
 # Read the CNVkit .cns files
 def convert_cnvkit_cns_to_bed(cnvkit_output_directory, base, cnsfile=None, rescaled=False, nofilter=False):
     if cnsfile is None:
         if not rescaled:
-            cnsfile = cnvkit_output_directory + base + ".cns"
+            cnsfile = os.path.join(cnvkit_output_directory, base + ".cns")
         else:
-            cnsfile = cnvkit_output_directory + base + "_rescaled.cns"
+            cnsfile = os.path.join(cnvkit_output_directory, base + "_rescaled.cns")
 
-    with open(cnsfile) as infile, open(cnvkit_output_directory + base + "_CNV_CALLS.bed", 'w') as outfile:
+    bedfile = os.path.join(cnvkit_output_directory, base + "_CNV_CALLS.bed")
+    with open(cnsfile) as infile, open(bedfile, 'w') as outfile:
         head = next(infile).rstrip().rsplit("\t")
         for line in infile:
             fields = line.rstrip().rsplit("\t")
@@ -228,40 +472,47 @@ def convert_cnvkit_cns_to_bed(cnvkit_output_directory, base, cnsfile=None, resca
             outline = "\t".join(fields[0:3] + ["CNVkit", str(cn)]) + "\n"
             outfile.write(outline)
 
-    return cnvkit_output_directory + base + "_CNV_CALLS.bed"
+    return bedfile
 
 
 def rescale_cnvkit_calls(ckpy_path, cnvkit_output_directory, base, cnsfile=None, ploidy=None, purity=None):
     if purity is None and ploidy is None:
         logging.warning("Warning: Rescaling called without --ploidy or --purity. Rescaling will have no effect.")
     if cnsfile is None:
-        cnsfile = cnvkit_output_directory + base + ".cns"
+        cnsfile = os.path.join(cnvkit_output_directory, base + ".cns")
 
     if purity < 0.4:
         logging.warning("WARNING! Rescaling a low purity sample may cause many false-positive seed regions!")
         
-    cmd = "{} {} call {} -m clonal".format(PY3_PATH, ckpy_path, cnsfile)
+    cmd_list = [PY3_PATH, ckpy_path, "call", cnsfile, "-m", "clonal"]
     if purity:
-        cmd += " --purity " + str(purity)
+        cmd_list.extend(["--purity", str(purity)])
     if ploidy:
-        cmd += " --ploidy " + str(ploidy)
+        cmd_list.extend(["--ploidy", str(ploidy)])
 
-    cmd += " -o " + cnvkit_output_directory + base + "_rescaled.cns"
-    logging.info("Rescaling CNVKit calls\n" + cmd)
-    call(cmd, shell=True)
+    cmd_list.extend(["-o", os.path.join(cnvkit_output_directory, base + "_rescaled.cns")])
+    logging.info("Rescaling CNVKit calls\n" + " ".join(cmd_list))
+    try:
+        _run(cmd_list)
+
+    except CalledProcessError:
+        logging.error("CNVKit call encountered a non-zero exit status. Exiting...\n")
+        sys.exit(1)
 
 
 def run_amplified_intervals(AA_interpreter, CNV_seeds_filename, sorted_bam, output_directory, sname, cngain,
-                            cnsize_min):
+                            cnsize_min, nthreads=1):
     logging.info("Running amplified_intervals")
-    AA_seeds_filename = "{}_AA_CNV_SEEDS".format(output_directory + sname)
-    cmd = "{} {}/amplified_intervals.py --ref {} --bed {} --bam {} --gain {} --cnsize_min {} --out {}".format(
-        AA_interpreter, AA_SRC, args.ref, CNV_seeds_filename, sorted_bam, str(cngain), str(cnsize_min),
-        AA_seeds_filename)
-
+    AA_seeds_filename = os.path.join(output_directory, sname + "_AA_CNV_SEEDS")
+    script = AA_SRC + "/amplified_intervals.py"
+    script_args = ["--ref", args.ref, "--bed", CNV_seeds_filename, "--bam", sorted_bam, "--gain", str(cngain),
+                   "--cnsize_min", str(cnsize_min), "--out", AA_seeds_filename]
+    cmd = " ".join([AA_interpreter, script] + script_args)
     logging.info(cmd + "\n")
-    exit_code = call(cmd, shell=True)
-    if exit_code != 0:
+    try:
+        _run_py_script(AA_interpreter, script, script_args, nthreads)
+
+    except CalledProcessError:
         logging.error("amplified_intervals.py returned a non-zero exit code. Exiting...\n")
         sys.exit(1)
 
@@ -280,71 +531,62 @@ def run_AA(amplified_interval_bed, AA_outdir, sname, args):
     sv_vcf = args.sv_vcf
     sv_vcf_no_filter = args.sv_vcf_no_filter
 
-    AA_version = \
-    Popen([AA_interpreter, AA_SRC + "/AmpliconArchitect.py", "--version"], stdout=PIPE, stderr=PIPE).communicate()[0].rstrip()
-    if not AA_version:
-        AA_version = \
-            Popen([AA_interpreter, AA_SRC + "/AmpliconArchitect.py", "--version"], stdout=PIPE, stderr=PIPE).communicate()[1].rstrip()
-
-    try:
-        AA_version = AA_version.decode('utf-8')
-    except UnicodeError:
-        pass
-
-    metadata_dict["AA_version"] = AA_version
-
-    cmd = "{} {}/AmpliconArchitect.py --ref {} --downsample {} --bed {} --bam {} --runmode {} --extendmode {} --out {}/{}".format(
-        AA_interpreter, AA_SRC, ref, str(downsample), amplified_interval_bed, sorted_bam, runmode, extendmode,
-        AA_outdir, sname)
+    cmd_list = [AA_interpreter, AA_SRC + "/AmpliconArchitect.py", "--ref", ref, "--downsample", str(downsample), "--bed",
+                amplified_interval_bed, "--bam", sorted_bam, "--runmode", runmode, "--extendmode", extendmode, "--out",
+                os.path.join(AA_outdir, sname)]
     if insert_sdevs is not None:
-        cmd += " --insert_sdevs {}".format(str(insert_sdevs))
+        cmd_list.extend(["--insert_sdevs", str(insert_sdevs)])
 
     if sv_vcf:
-        cmd += " --sv_vcf {}".format(sv_vcf)
+        cmd_list.extend(["--sv_vcf", sv_vcf])
         if sv_vcf_no_filter:
-            cmd += " --sv_vcf_no_filter"
+            cmd_list.append("--sv_vcf_no_filter")
 
+    cmd = " ".join(cmd_list)
     logging.info(cmd + "\n")
-    aa_exit_code = call(cmd, shell=True)
-    if aa_exit_code != 0:
+    try:
+        _run(cmd_list)
+
+    except CalledProcessError:
         logging.error("AmpliconArchitect returned a non-zero exit code. Exiting...\n")
         sys.exit(1)
 
     metadata_dict["AA_cmd"] = cmd
 
 
-def run_AC(AA_outdir, sname, ref, AC_outdir, AC_src):
+def run_AC(AA_outdir, sname, ref, AC_outdir, AC_src, nthreads=1):
     logging.info("Running AC")
     # make input file
-    class_output = AC_outdir + sname
+    class_output = os.path.join(AC_outdir, sname)
     input_file = class_output + ".input"
     bed_dir = class_output + "_classification_bed_files/"
     if os.path.exists(bed_dir):
         logging.warning("WARNING! AC files were not cleared prior to re-running. New classifications may become "
                         "mixed with previous classification files!")
 
-    cmd = "{}/make_input.sh {} {}".format(AC_src, AA_outdir, class_output)
-    logging.info(cmd)
-    call(cmd, shell=True)
+    cmd_list = [AC_src + "/make_input.sh", AA_outdir, class_output]
+    logging.info(" ".join(cmd_list))
+    try:
+        _run(cmd_list)
+
+    except CalledProcessError:
+        logging.error("make_input.sh returned a non-zero exit status. Cannot run AmpliconClassifier.")
+        return
 
     with open(input_file) as ifile:
         sample_info_dict["number_of_AA_amplicons"] = len(ifile.readlines())
 
-    cmd = "{} {}/amplicon_classifier.py -i {} --ref {} -o {}".format(PY3_PATH, AC_src, input_file, ref, class_output)
+    script = AC_src + "/amplicon_classifier.py"
+    script_args = ["-i", input_file, "--ref", ref, "-o", class_output]
+    cmd = " ".join([PY3_PATH, script] + script_args)
     logging.info(cmd + "\n")
-    call(cmd, shell=True)
-    metadata_dict["AC_cmd"] = cmd
-
-    # Get AC version
-    AC_version = \
-    Popen([PY3_PATH, AC_src + "/amplicon_classifier.py", "--version"], stdout=PIPE, stderr=PIPE).communicate()[
-        0].rstrip()
     try:
-        AC_version = AC_version.decode('utf-8')
-    except UnicodeError:
-        pass
+        _run_py_script(PY3_PATH, script, script_args, nthreads)
+
+    except CalledProcessError:
+        logging.error("AmpliconClassifier returned a non-zero exit status")
 
-    metadata_dict["AC_version"] = AC_version
+    metadata_dict["AC_cmd"] = cmd
 
     # iterate over the bed files and count anything that isn't "unknown" as a feature
     feat_count = 0
@@ -356,28 +598,34 @@ def run_AC(AA_outdir, sname, ref, AC_outdir, AC_src):
     sample_info_dict["number_of_AA_features"] = feat_count
 
 
-def make_AC_table(sname, AC_outdir, AC_src, run_metadata_file, sample_metadata_file, ref, cnv_bed=None):
+def make_AC_table(sname, AC_outdir, AC_src, run_metadata_file, sample_metadata_file, ref, cnv_bed=None, nthreads=1):
     # make the AC output table
-    class_output = AC_outdir + sname
+    class_output = os.path.join(AC_outdir, sname)
     input_file = class_output + ".input"
     summary_map_file = class_output + "_summary_map.txt"
     classification_file = class_output + "_amplicon_classification_profiles.tsv"
-    cmd = "{} {}/make_results_table.py -i {} --classification_file {} --summary_map {} --ref {}".format(
-        PY3_PATH, AC_src, input_file, classification_file, summary_map_file, ref)
+    script = AC_src + "/make_results_table.py"
+    script_args = ["-i", input_file, "--classification_file", classification_file, "--summary_map", summary_map_file,
+                   "--ref", ref]
 
     if cnv_bed:
-        cmd += " --cnv_bed " + cnv_bed
+        script_args.extend(["--cnv_bed", cnv_bed])
 
     if run_metadata_file:
-        cmd += " --run_metadata_file " + run_metadata_file
+        script_args.extend(["--run_metadata_file", run_metadata_file])
 
     if sample_metadata_file:
-        cmd += " --sample_metadata_file " + sample_metadata_file
+        script_args.extend(["--sample_metadata_file", sample_metadata_file])
 
-    logging.info(cmd + "\n")
-    call(cmd, shell=True)
+    logging.info(" ".join([PY3_PATH, script] + script_args) + "\n")
+    try:
+        _run_py_script(PY3_PATH, script, script_args, nthreads)
 
+    except CalledProcessError:
+        logging.error("make_results_table.py returned a non-zero exit status")
 
+
+@lru_cache(maxsize=8)
 def get_ref_sizes(ref_genome_size_file):
     chr_sizes = {}
     with open(ref_genome_size_file) as infile:
@@ -389,24 +637,27 @@ def get_ref_sizes(ref_genome_size_file):
     return chr_sizes
 
 
+@lru_cache(maxsize=8)
 def get_ref_centromeres(ref_name):
-    centromere_dict = {}
     fnameD = {"GRCh38": "GRCh38_centromere.bed", "GRCh37": "human_g1k_v37_centromere.bed",
               "hg19": "hg19_centromere.bed",
               "mm10": "mm10_centromere.bed", "GRCm38": "GRCm38_centromere.bed", "GRCh38_viral": "GRCh38_centromere.bed"}
+    cent_bounds = {}
     with open(AA_REPO + ref_name + "/" + fnameD[ref_name]) as infile:
         for line in infile:
             if not "centromere" in line and not "acen" in line:
                 continue
             fields = line.rstrip().rsplit("\t")
-            if fields[0] not in centromere_dict:
-                centromere_dict[fields[0]] = (fields[1], fields[2])
+            s, e = int(fields[1]), int(fields[2])
+            if fields[0] in cent_bounds:
+                s = min(s, cent_bounds[fields[0]][0])
+                e = max(e, cent_bounds[fields[0]][1])
 
-            else:
-                pmin = min(int(centromere_dict[fields[0]][0]), int(fields[1]))
-                pmax = max(int(centromere_dict[fields[0]][1]), int(fields[2]))
-                # pad with 20kb to avoid freebayes issues in calling near centromeres
-                centromere_dict[fields[0]] = (str(pmin - 20000), str(pmax + 20000))
+            cent_bounds[fields[0]] = (s, e)
+
+    # merge all centromere entries of a chromosome, padding once with 20kb to avoid freebayes issues in calling near
+    # centromeres
+    centromere_dict = {c: (str(s - 20000), str(e + 20000)) for c, (s, e) in cent_bounds.items()}
 
     return centromere_dict
 
@@ -428,27 +679,18 @@ def save_run_metadata(outdir, sname, args, launchtime, commandstring):
     metadata_dict["launch_datetime"] = launchtime
     metadata_dict["hostname"] = socket.gethostname()
     metadata_dict["ref_genome"] = args.ref
-    aapint = args.aa_python_interpreter if args.aa_python_interpreter else "python"
-    aa_python_v = Popen([aapint, "--version"], stdout=PIPE, stderr=PIPE).communicate()[0].rstrip()
-    try:
-        aa_python_v = aa_python_v.decode('utf-8')
-    except UnicodeError:
-        pass
-
-    metadata_dict["AA_python_version"] = aa_python_v
     metadata_dict["AmpliconSuite-pipeline_command"] = commandstring
     metadata_dict["AmpliconSuite-pipeline_version"] = __ampliconsuitepipeline_version__
     metadata_dict["Samtools version"] = "{}.{}".format(samtools_version[0], samtools_version[1])
 
-    for x in ["bwa_cmd", "cnvkit_cmd", "amplified_intervals_cmd", "AA_cmd", "AC_cmd", "cnvkit_version", "AA_version",
-              "AC_version"]:
+    for x in ["bwa_cmd", "cnvkit_cmd", "amplified_intervals_cmd", "AA_cmd", "AC_cmd", "AA_python_version",
+              "cnvkit_version", "AA_version", "AC_version"]:
         if x not in metadata_dict:
             metadata_dict[x] = "NA"
 
     # save the json dict
-    run_metadata_filename = outdir + sname + "_run_metadata.json"
-    with open(run_metadata_filename, 'w') as fp:
-        json.dump(metadata_dict, fp, indent=2)
+    run_metadata_filename = os.path.join(outdir, sname + "_run_metadata.json")
+    _dump_json(metadata_dict, run_metadata_filename)
 
     # sample_info_dict["run_metadata_file"] = run_metadata_filename
     return run_metadata_filename
@@ -468,7 +710,7 @@ def detect_run_failure(align_stderr_file, AA_outdir, sname, AC_outdir):
             return True
 
     if AA_outdir:
-        sumfile = AA_outdir + sname + "_summary.txt"
+        sumfile = os.path.join(AA_outdir, sname + "_summary.txt")
         if os.path.isfile(sumfile):
             namps = -1
             with open(sumfile) as infile:
@@ -483,7 +725,7 @@ def detect_run_failure(align_stderr_file, AA_outdir, sname, AC_outdir):
 
             for x in range(1, namps + 1):
                 try:
-                    fsize = os.stat(AA_outdir + sname + "_amplicon" + str(x) + "_cycles.txt").st_size
+                    fsize = os.stat(os.path.join(AA_outdir, sname + "_amplicon" + str(x) + "_cycles.txt")).st_size
 
                 except OSError:
                     fsize = 0
@@ -498,8 +740,8 @@ def detect_run_failure(align_stderr_file, AA_outdir, sname, AC_outdir):
 
     if AC_outdir:
         try:
-            fsize1 = os.stat(AC_outdir + sname + "_amplicon_classification_profiles.tsv").st_size
-            fsize2 = os.stat(AC_outdir + sname + "_result_table.tsv").st_size
+            fsize1 = os.stat(os.path.join(AC_outdir, sname + "_amplicon_classification_profiles.tsv")).st_size
+            fsize2 = os.stat(os.path.join(AC_outdir, sname + "_result_table.tsv")).st_size
 
         except OSError:
             fsize1 = 0
@@ -512,30 +754,36 @@ def detect_run_failure(align_stderr_file, AA_outdir, sname, AC_outdir):
     return False
 
 
+# returns the version string a tool reports for the given command. Some tools (and python2) print it to stderr.
+@lru_cache(maxsize=None)
+def _get_version(cmd):
+    stdout, stderr = Popen(list(cmd), stdout=PIPE, stderr=PIPE).communicate()
+    version = stdout.rstrip() or stderr.rstrip()
+    try:
+        version = version.decode('utf-8')
+    except UnicodeError:
+        pass
+
+    return version
+
+
 def get_samtools_version(samtools):
     try:
-        # Run the command to get the version information
-        result = Popen([samtools], stderr=PIPE, stdout=PIPE)
-        _, output = result.communicate()
-
-        # Decode the output if it's in bytes (Python 3)
-        if isinstance(output, bytes):
-            output = output.decode('utf-8')
-
-        # Parse the version information to extract major and minor versions
-        version_pattern = r'Version: (\d+)\.(\d+)'
-        match = re.search(version_pattern, output)
-        if match:
-            major_version = int(match.group(1))
-            minor_version = int(match.group(2))
-            return major_version, minor_version
-        else:
-            # Return None if version information couldn't be parsed
-            return None, None
-    except OSError as e:
+        # samtools prints its usage, including the version, when run without arguments. The probe is cached.
+        output = _get_version((samtools,))
+
+    except OSError:
         # Handle the case when Samtools is not found
         logging.error("Error: Samtools not found. Please make sure it is installed and in your PATH.")
-        return None, None
+        return None
+
+    # Parse the version information to extract major and minor versions
+    match = re.search(r'Version: (\d+)\.(\d+)', output)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+
+    # Return None if version information couldn't be parsed
+    return None
 
 
 def download_file(url, destination_folder):
@@ -568,6 +816,15 @@ def extract_tar_gz(file_path, destination_folder):
     os.remove(file_path)
 
 
+# number of CPUs this process may run on. This respects cgroup/taskset limits (Docker, Slurm) where available.
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 def contains_spaces(file_path):
     return any(char == ' ' for char in file_path)
 
@@ -620,6 +877,8 @@ if __name__ == '__main__':
                         "increase for sequencing runs with high variance after insert size selection step. (default "
                         "3.0)", metavar="FLOAT", type=float, default=None)
     parser.add_argument("--normal_bam", metavar='FILE', help="Path to matched normal bam for CNVKit (optional)")
+    parser.add_argument("--cnvkit_ref_cache_dir", metavar='PATH', help="Directory in which to keep the CNVKit reference "
+                        "built from --normal_bam, so that later runs with the same normal reuse it (optional)")
     parser.add_argument("--ploidy", metavar='FLOAT', type=float, help="Ploidy estimate for CNVKit (optional). This is not used outside of CNVKit.",
                         default=None)
     parser.add_argument("--purity", metavar='FLOAT', type=float, help="Tumor purity estimate for CNVKit (optional). This is not used outside of CNVKit.",
@@ -632,6 +891,8 @@ if __name__ == '__main__':
     parser.add_argument("--no_QC", help="Skip QC on the BAM file. Do not adjust AA insert_sdevs for "
                                         "poor-quality insert size distribution", action='store_true')
     parser.add_argument("--sample_metadata", metavar='FILE', help="JSON file of sample metadata to build on")
+    parser.add_argument("--cram", help="When aligning --fastqs, write the alignments as a CRAM file instead of a BAM "
+                                       "file (requires samtools >= 1.10)", action='store_true')
     parser.add_argument("--samtools_path", help="Path to samtools binary (e.g., /path/to/my/samtools). If unset, will use samtools on system path.",
                         default='')
     group = parser.add_mutually_exclusive_group()
@@ -652,8 +913,7 @@ if __name__ == '__main__':
                         action='store_true')
 
     # start timing
-    ta = time.time()
-    ti = ta
+    ti = perf_counter()
     launchtime = str(datetime.now())
     args = parser.parse_args()
 
@@ -692,16 +952,18 @@ if __name__ == '__main__':
     if not any([args.bam, args.fastqs, args.completed_AA_runs]):
         parser.error("One of --bam | --fastqs | --completed_AA_runs is required!")
 
+    # never run more threads than the CPUs actually allotted to this process
+    NTHREADS = min(int(args.nthreads), available_cpus())
+
     # set an output directory if user did not specify
     if not args.output_directory:
         args.output_directory = os.getcwd()
 
-    if not args.output_directory.endswith("/"):
-        args.output_directory += "/"
-
     sname = args.sample_name
     outdir = args.output_directory
-    sample_metadata_filename = args.output_directory + sname + "_sample_metadata.json"
+    sample_metadata_filename = os.path.join(outdir, sname + "_sample_metadata.json")
+    AA_outdir = os.path.join(outdir, sname + "_AA_results")
+    AC_outdir = os.path.join(outdir, sname + "_classification")
     
     # set samtools version for use
     if not args.samtools_path.endswith("/samtools"):
@@ -711,11 +973,10 @@ if __name__ == '__main__':
 
     # Make and clear necessary directories.
     # make the output directory location if it does not exist
-    if not os.path.exists(args.output_directory):
-        os.mkdir(args.output_directory)
+    os.makedirs(outdir, exist_ok=True)
 
     # initiate logging
-    paa_logfile = args.output_directory + sname + '.log'
+    paa_logfile = os.path.join(outdir, sname + '.log')
     logging.basicConfig(filename=paa_logfile, format='[%(name)s:%(levelname)s]\t%(message)s',
                         level=logging.INFO, filemode='w')
     console_handler = logging.StreamHandler()
@@ -735,12 +996,15 @@ if __name__ == '__main__':
 
     logging.info("AmpliconSuite-pipeline command:")
     logging.info(commandstring + "\n")
+    if NTHREADS < int(args.nthreads):
+        logging.warning("Only {} CPUs are available to this process, using {} threads instead of {}".format(
+            NTHREADS, NTHREADS, args.nthreads))
 
     if "/" in args.sample_name:
         logging.error("Sample name -s cannot be a path. Specify output directory with -o.\n")
         sys.exit(1)
 
-    finish_flag_filename = args.output_directory + args.sample_name + "_finish_flag.txt"
+    finish_flag_filename = os.path.join(outdir, sname + "_finish_flag.txt")
     if os.path.exists(finish_flag_filename):
         logging.warning("WARNING: Running AmpliconSuite-pipeline.py with outputs directed into the same output location"
                         " as a previous run may cause crashes or other unexpected behavior. To avoid errors, clear "
@@ -749,8 +1013,7 @@ if __name__ == '__main__':
     with open(finish_flag_filename, 'w') as ffof:
         ffof.write("UNSUCCESSFUL\n")
 
-    timing_logfile = open(args.output_directory + args.sample_name + '_timing_log.txt', 'w')
-    timing_logfile.write("#stage:\twalltime(seconds)\n")
+    atexit.register(_write_stage_times, os.path.join(outdir, sname + '_timing_log.txt'))
 
     samtools_version = get_samtools_version(args.samtools_path)
     if samtools_version:
@@ -763,11 +1026,24 @@ if __name__ == '__main__':
     if args.AA_src:
         os.environ['AA_SRC'] = args.AA_src
 
-    if not os.path.exists(os.path.join(AA_REPO, "coverage.stats")):
+    # list the data repo once, so the checks below are set lookups rather than one stat call each
+    try:
+        with os.scandir(AA_REPO) as it:
+            repo_files = {e.name for e in it}
+
+    except FileNotFoundError:
+        repo_files = set()
+
+    if "coverage.stats" not in repo_files:
         logging.info("coverage.stats file not found in " + AA_REPO + "\nCreating a new coverage.stats file.")
-        cmd = "touch {}coverage.stats && chmod a+rw {}coverage.stats".format(AA_REPO, AA_REPO)
-        logging.info(cmd)
-        call(cmd, shell=True)
+        cov_stats_file = AA_REPO + "coverage.stats"
+        logging.info("touch {} && chmod a+rw {}".format(cov_stats_file, cov_stats_file))
+        try:
+            _run(["touch", cov_stats_file])
+            _run(["chmod", "a+rw", cov_stats_file])
+
+        except CalledProcessError:
+            logging.error("Could not create " + cov_stats_file)
 
     try:
         AA_SRC = os.environ['AA_SRC']
@@ -781,20 +1057,22 @@ if __name__ == '__main__':
             logging.error("AA_SRC bash variable or library files not found. AmpliconArchitect may not be properly installed.\n")
             sys.exit(1)
 
-    try:
-        AC_SRC = os.environ['AC_SRC']
-
-    except KeyError:
-        try:
-            import ampclasslib
-            ac_path = check_output("which amplicon_classifier.py", shell=True).decode("utf-8")
-            AC_SRC = ac_path.rsplit("/amplicon_classifier.py")[0]
-
-        except Exception as e:
-            logging.error(e)
-            logging.error(
-                "\nAC_SRC bash variable or library files not found. AmpliconClassifier may not be properly installed.\n")
-            sys.exit(1)
+    # AmpliconClassifier is only needed after AA or on completed AA runs. Its location is resolved once, here, so that a
+    # missing installation fails before any of the earlier stages are run.
+    AC_SRC = None
+    if (args.run_AA and args.run_AC) or args.completed_AA_runs:
+        AC_SRC = os.environ.get('AC_SRC')
+        if not AC_SRC:
+            try:
+                import ampclasslib
+                ac_path = check_output("which amplicon_classifier.py", shell=True).decode("utf-8")
+                AC_SRC = ac_path.rsplit("/amplicon_classifier.py")[0]
+
+            except Exception as e:
+                logging.error(e)
+                logging.error(
+                    "\nAC_SRC bash variable or library files not found. AmpliconClassifier may not be properly installed.\n")
+                sys.exit(1)
 
     if (args.fastqs or args.completed_AA_runs) and not args.ref:
         logging.error("Must specify --ref when providing unaligned fastq files or completed AA runs.\n")
@@ -823,18 +1101,19 @@ if __name__ == '__main__':
         args.cnvkit_dir += "cnvkit.py"
 
     if args.run_AA:
-        if not os.path.exists(os.environ["HOME"] + "/mosek/mosek.lic") and not "MOSEKLM_LICENSE_FILE" in os.environ:
-            logging.error("--run_AA set, but MOSEK license not found in $HOME/mosek/")
-            sys.exit(1)
-
-        elif "MOSEKLM_LICENSE_FILE" in os.environ:
-            if os.environ["MOSEKLM_LICENSE_FILE"].endswith("mosek.lic"):
-                logging.error("MOSEKLM_LICENSE_FILE should be the path of the directory of the license, not the full path. Please update your .bashrc, and run 'source ~/.bashrc'")
+        mosek_license_dir = os.environ.get("MOSEKLM_LICENSE_FILE")
+        if mosek_license_dir is None:
+            if not os.path.exists(os.environ["HOME"] + "/mosek/mosek.lic"):
+                logging.error("--run_AA set, but MOSEK license not found in $HOME/mosek/")
                 sys.exit(1)
 
-            elif not os.path.exists(os.environ["MOSEKLM_LICENSE_FILE"] + "/mosek.lic"):
-                logging.error("--run_AA set, but MOSEK license not found in " + os.environ["MOSEKLM_LICENSE_FILE"])
-                sys.exit(1)
+        elif mosek_license_dir.endswith("mosek.lic"):
+            logging.error("MOSEKLM_LICENSE_FILE should be the path of the directory of the license, not the full path. Please update your .bashrc, and run 'source ~/.bashrc'")
+            sys.exit(1)
+
+        elif not os.path.exists(mosek_license_dir + "/mosek.lic"):
+            logging.error("--run_AA set, but MOSEK license not found in " + mosek_license_dir)
+            sys.exit(1)
 
     runCNV = None
     if args.cnvkit_dir and not args.cnv_bed:
@@ -864,6 +1143,19 @@ if __name__ == '__main__':
         logging.error("--aa_python_interpreter must be a path of a valid python interpreter")
         sys.exit(1)
 
+    # probe the versions of the tools that will be run, once, for the run metadata
+    if not args.completed_AA_runs:
+        metadata_dict["AA_python_version"] = _get_version((args.aa_python_interpreter, "--version"))
+        if runCNV == "CNVkit":
+            metadata_dict["cnvkit_version"] = _get_version((PY3_PATH, args.cnvkit_dir, "version"))
+
+        if args.run_AA:
+            metadata_dict["AA_version"] = _get_version((args.aa_python_interpreter, AA_SRC + "/AmpliconArchitect.py",
+                                                        "--version"))
+
+    if (args.run_AA and args.run_AC) or args.completed_AA_runs:
+        metadata_dict["AC_version"] = _get_version((PY3_PATH, AC_SRC + "/amplicon_classifier.py", "--version"))
+
     refFnames = {x: None for x in ["hg19", "GRCh37", "GRCh38", "GRCh38_viral", "mm10"]}
     # Paths of all the repo files needed
     if args.ref == "hg38":
@@ -872,7 +1164,7 @@ if __name__ == '__main__':
         args.ref = "mm10"
 
     for rname in refFnames.keys():
-        if os.path.exists(AA_REPO + "/" + rname):
+        if rname in repo_files:
             refFnames[rname] = check_reference.get_ref_fname(AA_REPO, rname)
 
     faidict = {}
@@ -916,6 +1208,10 @@ if __name__ == '__main__':
     gdir = AA_REPO + args.ref + "/"
     ref_fasta = gdir + refFnames[args.ref]
     ref_genome_size_file = gdir + args.ref + "_noAlt.fa.fai"
+    if args.normal_bam and not os.path.isfile(args.normal_bam):
+        logging.error("Specified normal BAM file does not exist: " + args.normal_bam + "\n")
+        sys.exit(1)
+
     if args.cnv_bed and not os.path.isfile(args.cnv_bed):
         logging.error("Specified CNV bed file does not exist: " + args.cnv_bed + "\n")
         sys.exit(1)
@@ -929,163 +1225,198 @@ if __name__ == '__main__':
     sample_info_dict["reference_genome"] = args.ref
     sample_info_dict["sample_name"] = sname
 
-    tb = time.time()
-    timing_logfile.write("Initialization:\t" + "{:.2f}".format(tb - ta) + "\n")
-    ta = tb
+    _record_stage_time("Initialization:", ti)
     logging.info("Running AmpliconSuite-pipeline on sample: " + sname)
     # Begin pipeline
     aln_stage_stderr = None
-    if args.fastqs:
-        # Run BWA
-        if args.fastqs[0] == args.fastqs[1]:
-            logging.error(str(args.fastqs))
-            logging.error("You must provide two different fastq files for paired-end reads!\n")
-            sys.exit(1)
-
-        elif contains_spaces(args.fastqs[0]) or contains_spaces(args.fastqs[1]):
-            logging.error("FASTQ filepaths cannot contain spaces!")
-            sys.exit(1)
-
-        fastqs = " ".join(args.fastqs)
-        logging.info("Will perform alignment on " + fastqs)
-        args.bam, aln_stage_stderr = run_bwa(ref_fasta, fastqs, outdir, sname, args.nthreads, args.samtools_path, samtools_version)
-
     if not args.completed_AA_runs:
-        bamBaiNoExt = args.bam[:-3] + "bai"
-        cramCraiNoExt = args.bam[:-4] + "crai"
-        baiExists = os.path.isfile(args.bam + ".bai") or os.path.isfile(bamBaiNoExt)
-        craiExists = os.path.isfile(args.bam + ".crai") or os.path.isfile(cramCraiNoExt)
-        if not baiExists and not craiExists:
-            logging.info(args.bam + " index not found, calling samtools index")
-            call([args.samtools_path, "index", args.bam])
-            logging.info("Finished indexing")
-
-        bambase = os.path.splitext(os.path.basename(args.bam))[0]
-        prop_paired_proportion = None
+        with stage("Alignment and indexing"):
+            if args.fastqs:
+                # Run BWA
+                if args.fastqs[0] == args.fastqs[1]:
+                    logging.error(str(args.fastqs))
+                    logging.error("You must provide two different fastq files for paired-end reads!\n")
+                    sys.exit(1)
+
+                elif contains_spaces(args.fastqs[0]) or contains_spaces(args.fastqs[1]):
+                    logging.error("FASTQ filepaths cannot contain spaces!")
+                    sys.exit(1)
+
+                fastqs = " ".join(args.fastqs)
+                logging.info("Will perform alignment on " + fastqs)
+                args.bam, aln_stage_stderr = run_bwa(ref_fasta, fastqs, outdir, sname, NTHREADS,
+                                                     args.samtools_path, samtools_version, cram=args.cram)
+
+            else:
+                # run_bwa indexes the BAM it writes, so only an input BAM/CRAM may need indexing here
+                # list the BAM directory once rather than checking each possible index name separately
+                bam_dir = os.path.dirname(args.bam) or "."
+                with os.scandir(bam_dir) as it:
+                    bam_siblings = {e.name for e in it if e.is_file()}
+
+                bamName = os.path.basename(args.bam)
+                bamBaiNoExt = bamName[:-3] + "bai"
+                cramCraiNoExt = bamName[:-4] + "crai"
+                baiExists = bamName + ".bai" in bam_siblings or bamBaiNoExt in bam_siblings
+                craiExists = bamName + ".crai" in bam_siblings or cramCraiNoExt in bam_siblings
+                csiExists = bamName + ".csi" in bam_siblings
+                if not baiExists and not craiExists and not csiExists:
+                    logging.info(args.bam + " index not found, calling samtools index")
+                    cmd_list = [args.samtools_path, "index", args.bam]
+                    if samtools_version >= (1, 6):
+                        cmd_list[2:2] = ["-@", str(NTHREADS)]
+
+                    # build a .csi rather than a .bai for very large BAMs
+                    if args.bam.endswith(".bam") and os.path.getsize(args.bam) > CSI_INDEX_MIN_BYTES:
+                        cmd_list[2:2] = ["-c"]
+
+                    logging.info(" ".join(cmd_list))
+                    try:
+                        _run(cmd_list)
+
+                    except CalledProcessError:
+                        logging.error("samtools index encountered a non-zero exit status. Exiting...\n")
+                        sys.exit(1)
+
+                    logging.info("Finished indexing")
+
+            bambase = os.path.splitext(os.path.basename(args.bam))[0]
+        # the QC is a full pass over the BAM that nothing depends on until AA, so it runs in the background while
+        # the CNV calling and seed filtering proceed. It is waited for before CNVkit, the longest of those steps, so
+        # that an unsuitable BAM stops the run before the CNV calls are made.
+        qc_future = None
         if not args.no_QC:
             logging.debug("samtools path is set to: " + args.samtools_path)
-            prop_paired_proportion = check_reference.check_properly_paired(args.bam, args.samtools_path)
-
-        tb = time.time()
-        timing_logfile.write("Alignment, indexing and QC:\t" + "{:.2f}".format(tb - ta) + "\n")
+            qc_executor = ThreadPoolExecutor(max_workers=1)
+            qc_future = qc_executor.submit(_timed_properly_paired_check, args.bam, args.samtools_path)
+            qc_executor.shutdown(wait=False)
 
         if args.align_only:
+            _check_qc_future(qc_future, wait=True)
             logging.info("Completed\n")
-            tf = time.time()
-            timing_logfile.write("Total_elapsed_walltime\t" + "{:.2f}".format(tf - ti) + "\n")
-            timing_logfile.close()
+            _record_stage_time("Total_elapsed_walltime", ti)
             sys.exit()
 
-        ta = tb
-        centromere_dict = get_ref_centromeres(args.ref)
-        chr_sizes = get_ref_sizes(ref_genome_size_file)
-        # coordinate CNV calling
-        cnvkit_output_directory = None
         if runCNV == "CNVkit":
-            cnvkit_output_directory = args.output_directory + sname + "_cnvkit_output/"
-            if not os.path.exists(cnvkit_output_directory):
-                os.mkdir(cnvkit_output_directory)
-
-            run_cnvkit(args.cnvkit_dir, args.nthreads, cnvkit_output_directory, args.bam,
-                       seg_meth=args.cnvkit_segmentation, normal=args.normal_bam, ref_fasta=ref_fasta)
-            if args.ploidy or args.purity:
-                rescale_cnvkit_calls(args.cnvkit_dir, cnvkit_output_directory, bambase, ploidy=args.ploidy,
-                                     purity=args.purity)
-                rescaling = True
-            else:
-                rescaling = False
+            _check_qc_future(qc_future, wait=True)
+
+        with stage("CNV calling"):
+            centromere_dict = get_ref_centromeres(args.ref)
+            chr_sizes = get_ref_sizes(ref_genome_size_file)
+            # coordinate CNV calling
+            cnvkit_output_directory = None
+            if runCNV == "CNVkit":
+                cnvkit_output_directory = os.path.join(outdir, sname + "_cnvkit_output")
+                os.makedirs(cnvkit_output_directory, exist_ok=True)
+
+                run_cnvkit(args.cnvkit_dir, NTHREADS, cnvkit_output_directory, args.bam,
+                           seg_meth=args.cnvkit_segmentation, normal=args.normal_bam, ref_fasta=ref_fasta)
+                if args.ploidy or args.purity:
+                    rescale_cnvkit_calls(args.cnvkit_dir, cnvkit_output_directory, bambase, ploidy=args.ploidy,
+                                         purity=args.purity)
+                    rescaling = True
+                else:
+                    rescaling = False
+
+                args.cnv_bed = convert_cnvkit_cns_to_bed(cnvkit_output_directory, bambase, rescaled=rescaling)
+
+            if args.cnv_bed.endswith(".cns"):
+                # reuse the bed converted from this same .cns by a previous run. The source path and mtime are recorded
+                # next to the bed, and the bed must not have been rewritten since.
+                cns_bed = os.path.join(outdir, bambase + "_CNV_CALLS.bed")
+                cns_source_file = cns_bed + ".source"
+                cns_source = "{}\t{}\n".format(os.path.realpath(args.cnv_bed), os.stat(args.cnv_bed).st_mtime_ns)
+                try:
+                    with open(cns_source_file) as infile:
+                        bed_is_current = infile.read() == cns_source and \
+                                         os.stat(cns_source_file).st_mtime_ns >= os.stat(cns_bed).st_mtime_ns
 
-            args.cnv_bed = convert_cnvkit_cns_to_bed(cnvkit_output_directory, bambase, rescaled=rescaling)
+                except FileNotFoundError:
+                    bed_is_current = False
 
-        if args.cnv_bed.endswith(".cns"):
-            args.cnv_bed = convert_cnvkit_cns_to_bed(outdir, bambase, cnsfile=args.cnv_bed, nofilter=True)
+                if bed_is_current:
+                    logging.info("Using " + cns_bed + ", previously converted from " + args.cnv_bed)
+                    args.cnv_bed = cns_bed
 
-        tb = time.time()
-        timing_logfile.write("CNV calling:\t" + "{:.2f}".format(tb - ta) + "\n")
-        ta = tb
+                else:
+                    args.cnv_bed = convert_cnvkit_cns_to_bed(outdir, bambase, cnsfile=args.cnv_bed, nofilter=True)
+                    with open(cns_source_file, 'w') as outfile:
+                        outfile.write(cns_source)
 
         sample_info_dict["sample_cnv_bed"] = args.cnv_bed
+        _check_qc_future(qc_future)
+
+        with stage("Seed filtering (amplified_intervals.py)"):
+            if not args.no_filter and not args.cnv_bed.endswith("_AA_CNV_SEEDS.bed"):
+                if not args.cnv_bed.endswith("_CNV_CALLS_pre_filtered.bed") and not args.cnv_bed.endswith("_CNV_CALLS_unfiltered_gains.bed"):
+                    from paalib import cnv_prefilter
+                    pfilt_odir = cnvkit_output_directory if cnvkit_output_directory else outdir
+                    args.cnv_bed = cnv_prefilter.prefilter_bed(args.cnv_bed, args.ref, centromere_dict, chr_sizes,
+                                                               args.cngain, pfilt_odir)
+
+                amplified_interval_bed = run_amplified_intervals(args.aa_python_interpreter, args.cnv_bed, args.bam,
+                                                                 outdir, sname, args.cngain, args.cnsize_min,
+                                                                 nthreads=NTHREADS)
+
+            elif args.no_filter and runCNV:
+                if not args.cnv_bed.endswith("_CNV_CALLS_pre_filtered.bed") and not args.cnv_bed.endswith("_CNV_CALLS_unfiltered_gains.bed"):
+                    from paalib import cnv_prefilter
+                    pfilt_odir = cnvkit_output_directory if cnvkit_output_directory else outdir
+                    args.cnv_bed = cnv_prefilter.prefilter_bed(args.cnv_bed, args.ref, centromere_dict, chr_sizes,
+                                                               args.cngain, pfilt_odir)
+                    logging.info("Skipping amplified_intervals.py step due to --no_filter")
 
-        if not args.no_filter and not args.cnv_bed.endswith("_AA_CNV_SEEDS.bed"):
-            if not args.cnv_bed.endswith("_CNV_CALLS_pre_filtered.bed") and not args.cnv_bed.endswith("_CNV_CALLS_unfiltered_gains.bed"):
-                from paalib import cnv_prefilter
-                pfilt_odir = cnvkit_output_directory if cnvkit_output_directory else args.output_directory
-                args.cnv_bed = cnv_prefilter.prefilter_bed(args.cnv_bed, args.ref, centromere_dict, chr_sizes,
-                                                           args.cngain, pfilt_odir)
-
-            amplified_interval_bed = run_amplified_intervals(args.aa_python_interpreter, args.cnv_bed, args.bam,
-                                                             outdir, sname, args.cngain, args.cnsize_min)
-
-        elif args.no_filter and runCNV:
-            if not args.cnv_bed.endswith("_CNV_CALLS_pre_filtered.bed") and not args.cnv_bed.endswith("_CNV_CALLS_unfiltered_gains.bed"):
-                from paalib import cnv_prefilter
-                pfilt_odir = cnvkit_output_directory if cnvkit_output_directory else args.output_directory
-                args.cnv_bed = cnv_prefilter.prefilter_bed(args.cnv_bed, args.ref, centromere_dict, chr_sizes,
-                                                           args.cngain, pfilt_odir)
-                logging.info("Skipping amplified_intervals.py step due to --no_filter")
-
-        else:
-            logging.info("Skipping filtering of bed file.")
-            amplified_interval_bed = args.cnv_bed
+            else:
+                logging.info("Skipping filtering of bed file.")
+                amplified_interval_bed = args.cnv_bed
 
-        tb = time.time()
-        timing_logfile.write("Seed filtering (amplified_intervals.py):\t" + "{:.2f}".format(tb - ta) + "\n")
-        ta = tb
+        # collect the QC result. A failed QC exits here.
+        prop_paired_proportion = _check_qc_future(qc_future, wait=True)
 
         # Run AA
         if args.run_AA:
-            AA_outdir = outdir + sname + "_AA_results/"
-            if not os.path.exists(AA_outdir):
-                os.mkdir(AA_outdir)
+            os.makedirs(AA_outdir, exist_ok=True)
 
             # set the insert sdevs if not given by user.
             if not args.no_QC and not args.AA_insert_sdevs and prop_paired_proportion is not None and prop_paired_proportion < 90:
                 logging.info("Properly paired rate less than 90%, setting --insert_sdevs 9.0 for AA")
                 args.AA_insert_sdevs = 9.0
 
-            run_AA(amplified_interval_bed, AA_outdir, sname, args)
-            tb = time.time()
-            timing_logfile.write("AmpliconArchitect:\t" + "{:.2f}".format(tb - ta) + "\n")
-            ta = tb
+            with stage("AmpliconArchitect"):
+                run_AA(amplified_interval_bed, AA_outdir, sname, args)
+
             # Run AC
             if args.run_AC:
-                AC_outdir = outdir + sname + "_classification/"
-                if not os.path.exists(AC_outdir):
-                    os.mkdir(AC_outdir)
-
-                run_AC(AA_outdir, sname, args.ref, AC_outdir, AC_SRC)
+                os.makedirs(AC_outdir, exist_ok=True)
 
-                tb = time.time()
-                timing_logfile.write("AmpliconClassifier:\t" + "{:.2f}".format(tb - ta) + "\n")
+                with stage("AmpliconClassifier"):
+                    run_AC(AA_outdir, sname, args.ref, AC_outdir, AC_SRC, nthreads=NTHREADS)
 
-        run_metadata_filename = save_run_metadata(outdir, sname, args, launchtime, commandstring)
+        # write the run metadata and sample metadata files concurrently. make_AC_table reads both.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            md_future = executor.submit(save_run_metadata, outdir, sname, args, launchtime, commandstring)
+            _dump_json(sample_info_dict, sample_metadata_filename)
 
-        with open(sample_metadata_filename, 'w') as fp:
-            json.dump(sample_info_dict, fp, indent=2)
+            run_metadata_filename = md_future.result()
 
         if args.run_AA and args.run_AC:
             make_AC_table(sname, AC_outdir, AC_SRC, run_metadata_filename, sample_metadata_filename,
-                          args.ref, cnv_bed=sample_info_dict["sample_cnv_bed"])
+                          args.ref, cnv_bed=sample_info_dict["sample_cnv_bed"], nthreads=NTHREADS)
 
     else:
-        ta = time.time()
         if not args.ref:
             logging.error("--ref is a required argument if --completed_AA_runs is provided!")
             sys.exit(1)
 
-        AC_outdir = outdir + sname + "_classification/"
-        if not os.path.exists(AC_outdir):
-            os.mkdir(AC_outdir)
+        os.makedirs(AC_outdir, exist_ok=True)
 
-        run_AC(args.completed_AA_runs, sname, args.ref, AC_outdir, AC_SRC)
+        with stage("AmpliconClassifier"):
+            run_AC(args.completed_AA_runs, sname, args.ref, AC_outdir, AC_SRC, nthreads=NTHREADS)
 
-        tb = time.time()
-        timing_logfile.write("AmpliconClassifier:\t" + "{:.2f}".format(tb - ta) + "\n")
+        _dump_json(sample_info_dict, sample_metadata_filename)
 
-        with open(sample_metadata_filename, 'w') as fp:
-            json.dump(sample_info_dict, fp, indent=2)
-
-        make_AC_table(sname, AC_outdir, AC_SRC, args.completed_run_metadata, sample_metadata_filename, args.ref)
+        make_AC_table(sname, AC_outdir, AC_SRC, args.completed_run_metadata, sample_metadata_filename, args.ref,
+                      nthreads=NTHREADS)
 
     if not args.run_AA:
         AA_outdir = None
@@ -1095,10 +1426,7 @@ if __name__ == '__main__':
 
     if not detect_run_failure(aln_stage_stderr, AA_outdir, sname, AC_outdir):
         logging.info("All stages appear to have completed successfully.")
-        with open(args.output_directory + args.sample_name + "_finish_flag.txt", 'w') as ffof:
+        with open(finish_flag_filename, 'w') as ffof:
             ffof.write("All stages completed\n")
 
-
-    tf = time.time()
-    timing_logfile.write("Total_elapsed_walltime\t" + "{:.2f}".format(tf - ti) + "\n")
-    timing_logfile.close()
+    _record_stage_time("Total_elapsed_walltime", ti)
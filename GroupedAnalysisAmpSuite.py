@@ -3,12 +3,12 @@
 # author: Jens Luebeck (jluebeck [at] ucsd.edu)
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 import random
 from subprocess import *
 import sys
 import time
-import threading
 
 from paalib._version import __ampliconsuitepipeline_version__
 
@@ -33,8 +33,7 @@ def generate_individual_seeds(cmd_dict, aa_py, parent_odir, cnv_bed_dict):
     print('Generating individual seeds')
     for sname, argstring in cmd_dict.items():
         odir = "{}{}/".format(parent_odir, sname)
-        if not os.path.exists(odir):
-            os.makedirs(odir)
+        os.makedirs(odir, exist_ok=True)
 
         with open("{}{}_CNV_out.txt".format(odir, sname), 'w') as outfile:
             cmd = '{} {}{}'.format(aa_py, PAA_PATH, argstring)
@@ -89,23 +88,14 @@ def group_seeds(individual_seed_dct, odir):
     return gs_dict
 
 
-def launch_AA_AC(jobq, aa_py, PAA_PATH, parent_odir):
-    while jobq:
-        try:
-            sname, arg_string = jobq.pop()
-
-        except IndexError:
-            return
-
-        odir = parent_odir + sname
-        with open("{}/{}_AA_AC_out.txt".format(odir, sname), 'w') as outfile:
-            time.sleep(random.uniform(0, 0.75))
-            cmd = "{} {}{}".format(aa_py, PAA_PATH, arg_string)
-            print("\nLaunching AA+AC job for " + sname + "\n" + cmd)
-            ecode = call(cmd, stdout=outfile, stderr=outfile, shell=True)
-            if ecode != 0:
-                sys.stderr.write("Unexpected error while running AA+AC job!\n")
-                sys.exit(1)
+def launch_AA_AC(job, aa_py, PAA_PATH, parent_odir):
+    sname, arg_string = job
+    odir = parent_odir + sname
+    with open("{}/{}_AA_AC_out.txt".format(odir, sname), 'w') as outfile:
+        time.sleep(random.uniform(0, 0.75))
+        cmd = "{} {}{}".format(aa_py, PAA_PATH, arg_string)
+        print("\nLaunching AA+AC job for " + sname + "\n" + cmd)
+        return call(cmd, stdout=outfile, stderr=outfile, shell=True)
 
 
 def create_AA_AC_cmds(tumor_lines, base_argstring, grouped_seeds, parent_odir):
@@ -314,8 +304,7 @@ if __name__ == '__main__':
     if args.output_directory and not args.output_directory.endswith('/'):
         args.output_directory += '/'
 
-    if not os.path.exists(args.output_directory):
-        os.makedirs(args.output_directory)
+    os.makedirs(args.output_directory, exist_ok=True)
 
     if not args.aa_python_interpreter:
         args.aa_python_interpreter = 'python'
@@ -356,12 +345,10 @@ if __name__ == '__main__':
         for nl in range(len(normal_lines)):
             grouped_seeds[normal_lines[nl][0]] = grouped_seeds[tumor_lines[0][0]]
             odir = "{}{}/".format(args.output_directory, normal_lines[nl][0])
-            if not os.path.exists(odir):
-                os.makedirs(odir)
+            os.makedirs(odir, exist_ok=True)
 
         all_lines = normal_lines + tumor_lines
         cmd_dict = create_AA_AC_cmds(all_lines, base_argstring, grouped_seeds, args.output_directory)
-        threadL = []
         paa_threads = min(args.nthreads, len(all_lines))
         print("\nQueueing " + str(len(all_lines)) + " PAA jobs")
         jobq = []
@@ -370,13 +357,14 @@ if __name__ == '__main__':
             cmd_string = cmd_dict[sname]
             jobq.append((sname, cmd_string))
 
-        for i in range(paa_threads):
-            threadL.append(threading.Thread(target=launch_AA_AC, args=(jobq, args.aa_python_interpreter, PAA_PATH,
-                                                                       args.output_directory)))
-            threadL[i].start()
+        with ThreadPoolExecutor(max_workers=paa_threads) as executor:
+            futures = [executor.submit(launch_AA_AC, job, args.aa_python_interpreter, PAA_PATH,
+                                       args.output_directory) for job in jobq]
+            ecodes = [f.result() for f in futures]
 
-        for t in threadL:
-            t.join()
+        if any(ecode != 0 for ecode in ecodes):
+            sys.stderr.write("Unexpected error while running AA+AC job!\n")
+            sys.exit(1)
 
         print("All AA & AC jobs completed")
 
@@ -118,13 +118,13 @@ def prefilter_bed(bedfile, ref, centromere_dict, chr_sizes, cngain, outdir):
     # interval to arm lookup
     region_ivald = defaultdict(IntervalTree)
     for key, value in chr_sizes.items():
-        try:
-            cent_tup = centromere_dict[key]
+        cent_tup = centromere_dict.get(key)
+        if cent_tup:
             region_ivald[key].addi(0, int(cent_tup[0]), key + "p")
             region_ivald[key].addi(int(cent_tup[1]), int(value), key + "q")
 
         # handle mitochondrial contig or other things (like viral genomes)
-        except KeyError:
+        else:
             region_ivald[key].addi(0, int(value), key)
 
     # store cnv calls per arm